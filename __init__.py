@@ -1,12 +1,19 @@
 from __future__ import print_function
 
 import ctypes
+import gzip
 import inspect
+import math
+import os
+import re
 import shlex
+import tarfile
 import tempfile
 import threading
+import time
 from queue import Queue, Empty
-from typing import List, Callable, Optional
+from array import array
+from typing import List, Callable, Optional, Dict, Tuple
 from subprocess import \
     CalledProcessError, \
     call, \
@@ -46,6 +53,88 @@ def _from_proc_output(output: bytes) -> str:
     return str(output, encoding='utf-8').strip(' \t\n')
 
 
+def _check_tar_member(member: tarfile.TarInfo, dest: str):
+    """
+    Check that extracting a tar member stays within dest, for Pythons
+    without extraction filters
+    :param member: tar member to be extracted
+    :param dest: destination directory
+    :return: None, or throw a TarError if unsafe
+    """
+    names = [member.name]
+    if member.islnk():  # hard links are created by copying the target
+        names.append(member.linkname)
+    root = os.path.realpath(dest)
+    for name in names:
+        if os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+            raise tarfile.TarError('Unsafe path in tar stream: %s' % name)
+        path = os.path.realpath(os.path.join(root, name))  # follow extracted links
+        if os.path.commonpath([root, path]) != root:
+            raise tarfile.TarError('Path out of destination in tar stream: %s' % name)
+
+
+class _CountingStream:
+    """
+    Wrap a binary stream, and count bytes read from/written to it
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.count += len(data)
+        return data
+
+    def write(self, data):
+        self.count += len(data)
+        return self._stream.write(data)
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        self._stream.close()
+
+
+class AdbTransferStats:
+    """
+    Statistics of a directory transfer
+    """
+
+    def __init__(self, size: int, wire_size: int, seconds: float, compressed: bool):
+        """
+        :param size: bytes of transferred files
+        :param wire_size: bytes actually sent over adb
+        :param seconds: elapsed time in second
+        :param compressed: whether the stream is gzipped
+        """
+        self.size = size
+        self.wire_size = wire_size
+        self.seconds = seconds
+        self.compressed = compressed
+
+    @property
+    def throughput(self) -> float:
+        """
+        Effective throughput of file contents, in bytes per second
+        """
+        return self.size / self.seconds if self.seconds > 0 else math.inf
+
+    @property
+    def wire_throughput(self) -> float:
+        """
+        Throughput over adb, in bytes per second
+        """
+        return self.wire_size / self.seconds if self.seconds > 0 else math.inf
+
+    def __repr__(self):
+        return '<AdbTransferStats %d bytes (%d on wire%s) in %.3fs, %.2f MB/s>' % (
+            self.size, self.wire_size, ', gzipped' if self.compressed else '',
+            self.seconds, self.throughput / 1e6)
+
+
 class NonBlockingReader:
 
     class TimeoutException(Exception):
@@ -143,6 +232,12 @@ class AdbCommand:
 # (True for terminating, and o.w. False)
 AdbPollCommandCallback = Callable[[bool, str], bool]
 
+# An AdbPollMetricsCallback is a function which accepts
+# (whether timeout, the sample (timestamp, values) or None)
+# as inputs, and returns a flag to terminate the sampling
+# (True for terminating, and o.w. False)
+AdbPollMetricsCallback = Callable[[bool, Optional[Tuple[float, tuple]]], bool]
+
 
 #########################################
 # Adb Implementation
@@ -155,6 +250,28 @@ class Adb:
         AdbGlobalOption_s(),
     ]
 
+    # guessed link speeds (bytes per second) before any measurement
+    LINK_SPEED_USB = 25e6
+    LINK_SPEED_TCP = 3e6
+    LINK_SPEED_EMULATOR = 500e6
+    # directory transfers are gzipped only on links slower than this
+    COMPRESS_BELOW_LINK_SPEED = 40e6
+    # every so many auto-compressed transfers, one is sent uncompressed
+    # instead to measure the link
+    LINK_PROBE_EVERY = 8
+    # max number of files on target sampled for content type
+    CONTENT_PROBE_FILES = 256
+    # extensions of files that are already compressed
+    COMPRESSED_EXTENSIONS = {
+        '.apk', '.jar', '.zip', '.gz', '.tgz', '.xz', '.bz2', '.7z', '.zst',
+        '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+        '.mp3', '.mp4', '.m4a', '.aac', '.ogg', '.opus', '.webm', '.mkv',
+    }
+    # measured link speeds of directory transfers, {serial: bytes per second}
+    _link_speeds: dict = {}
+    # auto-compressed transfers since last uncompressed one, {serial: count}
+    _compressed_runs: dict = {}
+
     def __init__(self, log_command=True, log_output=True):
         """
         Adb is a python interface for adb
@@ -301,6 +418,48 @@ class Adb:
         adb_sub_cmd = [AdbCommand.PULL, *src, dest, self._convert_opts(opts)]
         return self._exec_command(adb_sub_cmd)
 
+    def pull_dir(self, src: str, dest: str, compress: Optional[bool] = None):
+        """
+        Pull a directory from target to host as one tar stream, which is
+        extracted on the fly, far cheaper than pull for many small files
+        :param src: path of the directory on target
+        :param dest: destination directory on host
+        :param compress: gzip on target or not, None for deciding automatically
+        :return: (0, AdbTransferStats) if succeeded, o.w. (returncode, error)
+        """
+        src = src.rstrip('/') or '/'
+        if compress is None:
+            compress = self._should_compress_dir(src, remote=True)
+        script = 'tar -cf - -C %s %s' % (
+            shlex.quote(os.path.dirname(src) or '/'),
+            shlex.quote(os.path.basename(src) or '.'))
+        if compress:  # report failures of tar rather than gzip
+            script = 'set -o pipefail; %s | gzip -1' % script
+        # shell -T (shell protocol without pty) rather than exec-out, so
+        # that stderr and return code of tar are kept apart from the stream
+        adb_sub_cmd = [AdbCommand.SHELL, '-T', script]
+        return self._transfer_dir(adb_sub_cmd, dest, compress, pull=True)
+
+    def push_dir(self, src: str, dest: str, compress: Optional[bool] = None):
+        """
+        Push a directory from host to target as one tar stream, which is
+        extracted on the fly, far cheaper than push for many small files
+        :param src: path of the directory on host
+        :param dest: destination directory on target
+        :param compress: gzip on host or not, None for deciding automatically
+        :return: (0, AdbTransferStats) if succeeded, o.w. (returncode, error)
+        """
+        if compress is None:
+            compress = self._should_compress_dir(src, remote=False)
+        script = 'tar -xf - -C %s' % shlex.quote(dest)
+        if compress:
+            script = 'gzip -dc | ' + script
+        script = 'mkdir -p %s && %s' % (shlex.quote(dest), script)
+        # exec-out (raw mode) is unable to signal EOF of stdin,
+        # hence shell -T (shell protocol without pty) is used
+        adb_sub_cmd = [AdbCommand.SHELL, '-T', script]
+        return self._transfer_dir(adb_sub_cmd, src, compress, pull=False)
+
     def devices(self, opts: Optional[list] = None):
         """
         Get list of all available devices including emulators
@@ -369,6 +528,31 @@ class Adb:
         return self._poll_cmd_output(adb_sub_cmd, timeout=timeout,
                                      callback=callback)
 
+    def poll_metrics(self, callback: AdbPollMetricsCallback, timeout,
+                     metrics: Optional[List[str]] = None,
+                     interval: float = 1.0, package: Optional[str] = None):
+        """
+        Sample device metrics by one long-lived loop on target
+        :param callback: callback to handle each sample
+        :param timeout: timeout for polling
+        :param metrics: metrics to sample (see AdbMetricsParser.METRICS)
+        :param interval: sampling period in second
+        :param package: package name, required by metric 'pkg_mem'
+        :return: return code
+        """
+        parser = AdbMetricsParser(metrics, package)
+
+        def on_line(timed_out, line):
+            if timed_out:
+                return callback(True, None)
+            sample = parser.feed(line)
+            if sample is None:
+                return False
+            return callback(False, sample)
+
+        return self.poll_out(shlex.quote(parser.script(interval)),
+                             callback=on_line, timeout=timeout)
+
     def install(self, apk: str, opts: Optional[list] = None):
         """
         Install *.apk on target
@@ -485,6 +669,157 @@ class Adb:
         adb_sub_cmd = [AdbCommand.GET_STATE]
         return self._exec_command(adb_sub_cmd)
 
+    def _should_compress_dir(self, path: str, remote: bool) -> bool:
+        """
+        Decide whether to compress a directory transfer by the speed of
+        the link, and the content type of files in the directory. Only
+        on slow links is the content checked, which, for a directory on
+        target, costs one more adb command listing up to
+        CONTENT_PROBE_FILES files
+        :param path: path of the directory
+        :param remote: True if the directory is on target, o.w. on host
+        :return: True for compressing
+        """
+        serial = self._serial
+        speed = Adb._link_speeds.get(serial)
+        if speed is None:  # not measured yet, guess by serial
+            if serial is not None and serial.startswith('emulator-'):
+                speed = Adb.LINK_SPEED_EMULATOR
+            elif serial is not None and ':' in serial:
+                speed = Adb.LINK_SPEED_TCP
+            else:
+                speed = Adb.LINK_SPEED_USB
+        if speed >= Adb.COMPRESS_BELOW_LINK_SPEED:
+            Adb._compressed_runs[serial] = 0
+            return False
+        runs = Adb._compressed_runs.get(serial, 0)
+        if runs >= Adb.LINK_PROBE_EVERY:  # probe the link uncompressed
+            Adb._compressed_runs[serial] = 0
+            return False
+
+        compress = self._is_compressible_dir(path, remote)
+        Adb._compressed_runs[serial] = runs + 1 if compress else 0
+        return compress
+
+    def _is_compressible_dir(self, path: str, remote: bool) -> bool:
+        """
+        Whether most (by size) files in a directory are not compressed yet
+        :param path: path of the directory
+        :param remote: True if the directory is on target, o.w. on host
+        :return: True if compressible
+        """
+        serial = self._serial
+        sizes = []  # (is compressed, size)
+        if remote:
+            script = "find %s -type f -exec stat -c '%%s %%n' {} + 2>/dev/null | head -n %d" % \
+                (shlex.quote(path), Adb.CONTENT_PROBE_FILES)
+            rc, out = self._exec_command([AdbCommand.SHELL, '-T', script])
+            self._serial = serial
+            if rc != 0:
+                return True
+            for line in out.splitlines():
+                size, _, name = line.partition(' ')
+                try:
+                    size = int(size)
+                except ValueError:
+                    continue
+                sizes.append((os.path.splitext(name)[1].lower()
+                              in Adb.COMPRESSED_EXTENSIONS, size))
+        else:
+            for root, _, files in os.walk(path):
+                for name in files:
+                    try:
+                        size = os.path.getsize(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    sizes.append((os.path.splitext(name)[1].lower()
+                                  in Adb.COMPRESSED_EXTENSIONS, size))
+        total = sum(w for _, w in sizes)
+        if total == 0:
+            return False
+        return sum(w for c, w in sizes if c) / total < 0.5
+
+    def _transfer_dir(self, adb_cmd: list, local: str, compress: bool, pull: bool):
+        """
+        Execute adb_cmd, and stream a tar archive from/to its stdout/stdin
+        :param adb_cmd: list pyadb command to execute
+        :param local: directory on host to extract to, or to archive
+        :param compress: whether the stream is gzipped
+        :param pull: True for reading from stdout, o.w. writing to stdin
+        :return: (0, AdbTransferStats) if succeeded, o.w. (returncode, error)
+        """
+        t = tempfile.TemporaryFile()
+        serial = self._serial
+        final_adb_cmd = self._prepare()
+        for e in adb_cmd:
+            if e != '':  # avoid items with empty string...
+                final_adb_cmd.append(e)  # ... so that final command doesn't
+                # contain extra spaces
+        if self._is_log_command_enabled:
+            print(_underline('-> ' + ' '.join(final_adb_cmd) + '\n'))
+
+        size = 0
+        error = None
+        start = time.monotonic()
+        if pull:
+            os.makedirs(local, exist_ok=True)
+            proc = Popen(final_adb_cmd, stdout=PIPE, stderr=t)
+            stream = _CountingStream(proc.stdout)
+            # refuse absolute paths and '..', by filter if supported
+            has_filter = hasattr(tarfile, 'tar_filter')
+            kwargs = {'filter': 'tar'} if has_filter else {}
+            try:
+                with tarfile.open(fileobj=stream, mode='r|*') as tar:
+                    members = 0
+                    for member in tar:
+                        members += 1
+                        size += member.size
+                        if not has_filter:
+                            _check_tar_member(member, local)
+                        tar.extract(member, local, **kwargs)
+                if members == 0:  # nothing archived on target
+                    error = 'no such directory on target'
+                while stream.read(65536):  # drain the trailing padding
+                    pass
+            except (tarfile.TarError, OSError) as e:
+                error = str(e)
+                proc.kill()
+            stream.close()
+        else:
+            proc = Popen(final_adb_cmd, stdin=PIPE, stdout=t, stderr=t)
+            stream = _CountingStream(proc.stdin)
+            # gzip level 1 like gzip -1 of pull_dir, rather than 9 of mode 'w|gz'
+            out = gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=1) \
+                if compress else stream
+            try:
+                with tarfile.open(fileobj=out, mode='w|') as tar:
+                    tar.add(local, arcname=os.path.basename(os.path.abspath(local)))
+                    size = sum(m.size for m in tar.getmembers())
+                if compress:
+                    out.close()  # flush the gzip trailer, leaving stream open
+            except (tarfile.TarError, OSError) as e:
+                error = str(e)
+            try:
+                stream.close()
+            except OSError:
+                pass
+        rc = proc.wait()
+        seconds = time.monotonic() - start
+
+        t.seek(0)
+        err = _from_proc_output(t.read())
+        t.close()
+        self._reset()  # reset state after each command
+        if rc != 0 or error is not None:
+            return rc if rc != 0 else 1, err or error
+        # small transfers are dominated by latency, and do not measure the link
+        if stream.count >= 1 << 20:
+            speed = stream.count / max(seconds, 1e-6)
+            if compress:  # bounded by gzip as well, only a lower bound of the link
+                speed = max(speed, Adb._link_speeds.get(serial, 0))
+            Adb._link_speeds[serial] = speed
+        return 0, AdbTransferStats(size, stream.count, seconds, compress)
+
     def _reset(self):
         """
         Reset self
@@ -625,6 +960,359 @@ class Adb:
         return 0
 
 
+#########################################
+# Adb Metrics
+#########################################
+
+def _to_float(s: str) -> float:
+    """
+    Convert a string to float, nan if failed
+    :param s: string to be converted
+    :return: converted float
+    """
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class AdbMetricsParser:
+    """
+    AdbMetricsParser generates the device-side sampling loop, and
+    parses its framed output back into samples. Each frame looks like:
+        @@S
+        <uptime in second>
+        @<metric>
+        <output of the metric command>
+        ...
+        @@E
+    """
+
+    BEGIN = '@@S'
+    END = '@@E'
+
+    # metric -> (device-side command, columns); files and outputs are
+    # read by shell builtins, so that no program is executed on target
+    # except dumpsys and sleep in each tick
+    METRICS: Dict[str, Tuple[str, List[str]]] = {
+        'cpu': ('read l < /proc/stat; echo "$l"',
+                ['cpu_busy']),
+        'mem': ('while read k v _; do case $k in '
+                'MemTotal:|MemAvailable:) echo "$k $v";; '
+                'esac; done < /proc/meminfo',
+                ['mem_total_kb', 'mem_available_kb']),
+        'battery': ('for f in capacity temp current_now voltage_now; do '
+                    'l=nan; read l 2>/dev/null < /sys/class/power_supply/battery/$f; '
+                    'echo "$l"; done',
+                    ['battery_level', 'battery_temp',
+                     'battery_current_ua', 'battery_voltage_uv']),
+        'pkg_mem': ('dumpsys meminfo %s | while read l; do case $l in '
+                    '*TOTAL*) echo "$l"; break;; esac; done',
+                    ['pkg_pss_kb']),
+    }
+    DEFAULT_METRICS = ['cpu', 'mem', 'battery']
+    # /proc/uptime is in centisecond, so is the sampling period
+    MIN_INTERVAL = 0.01
+
+    def __init__(self, metrics: Optional[List[str]] = None,
+                 package: Optional[str] = None):
+        """
+        :param metrics: metrics to sample, DEFAULT_METRICS if None
+        :param package: package name, required by metric 'pkg_mem'
+        """
+        self._metrics = list(metrics) if metrics is not None \
+            else list(AdbMetricsParser.DEFAULT_METRICS)
+        for m in self._metrics:
+            if m not in AdbMetricsParser.METRICS:
+                raise ValueError('Unknown metric: %s' % m)
+        if 'pkg_mem' in self._metrics and package is None:
+            raise ValueError('Metric pkg_mem requires a package')
+        self._package = package
+        self._columns = []
+        for m in self._metrics:
+            self._columns.extend(AdbMetricsParser.METRICS[m][1])
+        self._frame = None
+        self._prev_cpu = None
+
+    def columns(self) -> List[str]:
+        """
+        Get columns of each sample, in order
+        :return: columns
+        """
+        return list(self._columns)
+
+    def script(self, interval: float = 1.0) -> str:
+        """
+        Generate the device-side sampling loop, which sleeps only for
+        the rest of each period after sampling, so that the period does
+        not drift with the cost of sampling (e.g., dumpsys); a tick taking
+        longer than interval is followed by the next one immediately
+        :param interval: sampling period in second, at least MIN_INTERVAL
+        :return: shell script to run on target
+        """
+        if interval < AdbMetricsParser.MIN_INTERVAL:
+            raise ValueError('Interval must be at least %g: %g' %
+                             (AdbMetricsParser.MIN_INTERVAL, interval))
+        body = ['read u _ < /proc/uptime',
+                'echo %s' % AdbMetricsParser.BEGIN,
+                'echo "$u"']
+        for m in self._metrics:
+            cmd = AdbMetricsParser.METRICS[m][0]
+            if m == 'pkg_mem':
+                cmd = cmd % shlex.quote(self._package)
+            body.append('echo @%s' % m)
+            body.append(cmd)
+        body.append('echo %s' % AdbMetricsParser.END)
+        # r = period - (now - u), all in centisecond
+        body.append('read v _ < /proc/uptime')
+        body.append('r=$((%d - ${v%%.*}${v#*.} + ${u%%.*}${u#*.}))' %
+                    round(interval * 100))
+        body.append('if [ $r -gt 0 ]; then f=$((r % 100)); '
+                    '[ $f -lt 10 ] && f=0$f; sleep $((r / 100)).$f; fi')
+        return 'while :; do %s; done' % '; '.join(body)
+
+    def feed(self, line: str) -> Optional[Tuple[float, tuple]]:
+        """
+        Feed one line of output of the sampling loop
+        :param line: one line of output
+        :return: (timestamp, values) once a frame is done, o.w. None
+        """
+        line = line.strip()
+        if line == AdbMetricsParser.BEGIN:
+            self._frame = []
+            return None
+        if self._frame is None:  # not in a frame, drop it
+            return None
+        if line != AdbMetricsParser.END:
+            self._frame.append(line)
+            return None
+        frame, self._frame = self._frame, None
+        return self._parse_frame(frame)
+
+    def _parse_frame(self, frame: List[str]) -> Optional[Tuple[float, tuple]]:
+        """
+        Parse one frame into a sample
+        :param frame: lines between BEGIN and END
+        :return: (timestamp, values)
+        """
+        if len(frame) == 0:
+            return None
+        timestamp = _to_float(frame[0].split(' ')[0])
+        sections: Dict[str, List[str]] = {}
+        lines = None
+        for line in frame[1:]:
+            if line.startswith('@') and line[1:] in AdbMetricsParser.METRICS:
+                lines = sections.setdefault(line[1:], [])
+            elif lines is not None:
+                lines.append(line)
+        values = []
+        for m in self._metrics:
+            values.extend(getattr(self, '_parse_' + m)(sections.get(m, [])))
+        return timestamp, tuple(values)
+
+    def _parse_cpu(self, lines: List[str]) -> List[float]:
+        """
+        Compute cpu busy percentage since last sample from /proc/stat
+        """
+        parts = lines[0].split() if len(lines) > 0 else []
+        if len(parts) < 5 or parts[0] != 'cpu':
+            return [math.nan]
+        jiffies = [_to_float(p) for p in parts[1:9]]
+        if any(math.isnan(j) for j in jiffies):
+            return [math.nan]
+        idle = sum(jiffies[3:5])  # idle + iowait
+        total = sum(jiffies)
+        prev, self._prev_cpu = self._prev_cpu, (idle, total)
+        if prev is None or total <= prev[1]:
+            return [math.nan]
+        d_total = total - prev[1]
+        return [100.0 * (d_total - (idle - prev[0])) / d_total]
+
+    def _parse_mem(self, lines: List[str]) -> List[float]:
+        """
+        Parse MemTotal and MemAvailable (in kB) from /proc/meminfo
+        """
+        mem = {}
+        for line in lines:
+            parts = line.split()
+            if len(parts) >= 2:
+                mem[parts[0].rstrip(':')] = _to_float(parts[1])
+        return [mem.get('MemTotal', math.nan), mem.get('MemAvailable', math.nan)]
+
+    def _parse_battery(self, lines: List[str]) -> List[float]:
+        """
+        Parse capacity, temp (in degree celsius), current_now and
+        voltage_now from sysfs
+        """
+        values = [_to_float(line) for line in lines[:4]]
+        values.extend([math.nan] * (4 - len(values)))
+        values[1] = values[1] / 10  # in 0.1 degree celsius
+        return values
+
+    def _parse_pkg_mem(self, lines: List[str]) -> List[float]:
+        """
+        Parse total pss (in kB) from dumpsys meminfo <package>
+        """
+        for line in lines:
+            match = re.search(r'TOTAL\D*(\d+)', line)
+            if match is not None:
+                return [float(match.group(1))]
+        return [math.nan]
+
+
+class AdbMetricsSeries:
+    """
+    AdbMetricsSeries is a preallocated columnar time series, which
+    keeps the most recent `capacity` samples
+    """
+
+    def __init__(self, columns: List[str], capacity: int = 3600):
+        """
+        :param columns: columns of each sample, excluding timestamp
+        :param capacity: max number of samples to keep
+        """
+        if capacity < 1:
+            raise ValueError('Capacity must be positive: %d' % capacity)
+        self._columns = ['timestamp'] + list(columns)
+        self._capacity = capacity
+        self._data = {c: array('d', [math.nan]) * capacity for c in self._columns}
+        self._size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def columns(self) -> List[str]:
+        """
+        Get all columns, including timestamp
+        :return: columns
+        """
+        return list(self._columns)
+
+    def append(self, timestamp: float, values: tuple):
+        """
+        Append one sample, overwriting the oldest one if full
+        :param timestamp: timestamp of the sample
+        :param values: values of the sample, in order of columns
+        """
+        with self._lock:
+            i = self._next
+            self._data['timestamp'][i] = timestamp
+            for c, v in zip(self._columns[1:], values):
+                self._data[c][i] = v
+            self._next = (i + 1) % self._capacity
+            self._size = min(self._size + 1, self._capacity)
+
+    def column(self, name: str) -> array:
+        """
+        Get one column in chronological order
+        :param name: name of the column
+        :return: a copy of the column
+        """
+        with self._lock:
+            data = self._data[name]
+            if self._size < self._capacity:
+                return data[:self._size]
+            return data[self._next:] + data[:self._next]
+
+    def latest(self) -> Optional[dict]:
+        """
+        Get the latest sample
+        :return: {column: value}, or None if empty
+        """
+        with self._lock:
+            if self._size == 0:
+                return None
+            i = (self._next - 1) % self._capacity
+            return {c: self._data[c][i] for c in self._columns}
+
+    def to_numpy(self) -> dict:
+        """
+        Convert to NumPy arrays, numpy is required
+        :return: {column: numpy.ndarray}
+        """
+        import numpy
+        return {c: numpy.frombuffer(self.column(c), dtype=numpy.float64)
+                for c in self._columns}
+
+
+class AdbMetricsSampler:
+    """
+    AdbMetricsSampler samples metrics of many devices at once, each
+    in a background thread over one long-lived exec-out connection
+    """
+
+    def __init__(self, serials: List[str], metrics: Optional[List[str]] = None,
+                 interval: float = 1.0, package: Optional[str] = None,
+                 capacity: int = 3600):
+        """
+        :param serials: serial nos of devices/emulators
+        :param metrics: metrics to sample (see AdbMetricsParser.METRICS)
+        :param interval: sampling period in second, at least
+            AdbMetricsParser.MIN_INTERVAL
+        :param package: package name, required by metric 'pkg_mem'
+        :param capacity: max number of samples to keep for each device
+        """
+        parser = AdbMetricsParser(metrics, package)
+        parser.script(interval)  # validate interval
+        columns = parser.columns()
+        self._serials = list(serials)
+        self._metrics = metrics
+        self._interval = interval
+        self._package = package
+        self._stopped = False
+        self._threads: List[Thread] = []
+        self.series: Dict[str, AdbMetricsSeries] = \
+            {s: AdbMetricsSeries(columns, capacity) for s in self._serials}
+        self.errors: Dict[str, Exception] = {}
+
+    def start(self):
+        """
+        Start sampling on all devices
+        :return: self
+        """
+        if len(self._threads) > 0:
+            raise ThreadError('Sampler is already started')
+        self._stopped = False
+        self.errors = {}
+        self._threads = [Thread(target=self._run, args=(s,), daemon=True)
+                         for s in self._serials]
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        """
+        Stop sampling, and wait for all devices to finish
+        :return: self
+        """
+        self._stopped = True
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        return self
+
+    def _run(self, serial: str):
+        series = self.series[serial]
+
+        def on_sample(timeout, sample) -> bool:
+            if self._stopped:
+                return True
+            if not timeout:
+                series.append(*sample)
+            return False
+
+        adb = Adb(False, False)
+        adb.connect(serial)
+        try:
+            adb.poll_metrics(on_sample, timeout=max(1, int(self._interval * 1000)),
+                             metrics=self._metrics, interval=self._interval,
+                             package=self._package)
+        except Exception as e:  # record it, rather than dying silently
+            self.errors[serial] = e
+
+
 if __name__ == '__main__':
     adb = Adb(False, False)
 
@@ -672,4 +1360,118 @@ if __name__ == '__main__':
             return False
         adb.poll_out('getevent -tlq', callback=on_event, timeout=0, shell=False)
 
+    def check_metrics_parser():
+        parser = AdbMetricsParser(['cpu', 'mem', 'battery', 'pkg_mem'], 'com.example')
+        frame = ['@@S', '100.50', '@cpu', 'cpu  %d 0 %d %d 0 0 0 0 0 0',
+                 '@mem', 'MemTotal: 4000', 'MemAvailable: 1000',
+                 '@battery', '87', '315', 'nan', '4000000',
+                 '@pkg_mem', 'TOTAL PSS:    54321            TOTAL RSS:   99999',
+                 '@@E']
+        samples = []
+        for user, system, idle in [(100, 100, 800), (175, 125, 900)]:
+            for line in frame:
+                if line.startswith('cpu'):
+                    line = line % (user, system, idle)
+                sample = parser.feed(line + '\n')
+                if sample is not None:
+                    samples.append(sample)
+        assert parser.columns() == ['cpu_busy', 'mem_total_kb', 'mem_available_kb',
+                                    'battery_level', 'battery_temp',
+                                    'battery_current_ua', 'battery_voltage_uv',
+                                    'pkg_pss_kb']
+        assert len(samples) == 2
+        timestamp, values = samples[0]
+        assert timestamp == 100.5 and math.isnan(values[0])  # no previous cpu
+        _, values = samples[1]
+        assert values[0] == 50.0  # busy 100 of 200 jiffies
+        assert values[1:5] == (4000.0, 1000.0, 87.0, 31.5)
+        assert math.isnan(values[5]) and values[6:] == (4000000.0, 54321.0)
+        # lines out of a frame, and garbled lines are tolerated
+        assert parser.feed('garbage') is None
+        for line in ['@@S', '1.00', '@cpu', 'cpu x y', '@@E']:
+            sample = parser.feed(line)
+        assert math.isnan(sample[1][0])
+        try:
+            AdbMetricsParser(['cpu']).script(0.001)
+            assert False
+        except ValueError:
+            pass
+
+    def check_metrics_series():
+        series = AdbMetricsSeries(['a'], capacity=3)
+        assert len(series) == 0 and series.latest() is None
+        for i in range(5):
+            series.append(float(i), (i * 10.0,))
+        assert len(series) == 3
+        assert list(series.column('timestamp')) == [2.0, 3.0, 4.0]
+        assert list(series.column('a')) == [20.0, 30.0, 40.0]
+        assert series.latest() == {'timestamp': 4.0, 'a': 40.0}
+        try:
+            AdbMetricsSeries(['a'], capacity=0)
+            assert False
+        except ValueError:
+            pass
+
+    def check_compress_decision():
+        checker = Adb(False, False)
+        checker.s('192.168.1.2:5555')  # tcp, slow by guess
+        listings = []
+
+        def fake_exec_command(adb_cmd):  # fake listing of the dir on target
+            listings.append(adb_cmd)
+            return 0, '3000000 /d/a.mp4\n10 /d/b.txt\nfind: /d/x: Permission denied\n'
+
+        checker._exec_command = fake_exec_command
+        assert not checker._should_compress_dir('/d', remote=True)  # mostly mp4
+        checker._exec_command = lambda _: (0, '3000 /d/a.txt\n10 /d/b.mp4\n')
+        assert checker._should_compress_dir('/d', remote=True)
+        assert 'head -n' in listings[0][-1]
+        # an uncompressed probe every LINK_PROBE_EVERY compressed transfers
+        decisions = [checker._should_compress_dir('/d', remote=True)
+                     for _ in range(Adb.LINK_PROBE_EVERY)]
+        assert decisions == [True] * (Adb.LINK_PROBE_EVERY - 1) + [False]
+        # a fast link, measured even by a gzipped transfer, disables it
+        Adb._link_speeds['192.168.1.2:5555'] = Adb.COMPRESS_BELOW_LINK_SPEED
+        checker._exec_command = fake_exec_command
+        del listings[:]
+        assert not checker._should_compress_dir('/d', remote=True)
+        assert len(listings) == 0  # decided without listing the target
+        # a directory on host is weighed by size as well
+        Adb._link_speeds.pop('192.168.1.2:5555')
+        Adb._compressed_runs.pop('192.168.1.2:5555')
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'a.txt'), 'w') as f:
+                f.write('a' * 1000)
+            assert checker._should_compress_dir(d, remote=False)
+            with open(os.path.join(d, 'b.png'), 'wb') as f:
+                f.write(b'b' * 2000)
+            assert not checker._should_compress_dir(d, remote=False)
+
+    def check_tar_member():
+        with tempfile.TemporaryDirectory() as d:
+            _check_tar_member(tarfile.TarInfo('app/sub/a.txt'), d)
+            for name in ['/etc/passwd', '../evil', 'app/../../evil']:
+                try:
+                    _check_tar_member(tarfile.TarInfo(name), d)
+                    assert False
+                except tarfile.TarError:
+                    pass
+            link = tarfile.TarInfo('app/link')
+            link.type, link.linkname = tarfile.LNKTYPE, '../../etc/passwd'
+            try:
+                _check_tar_member(link, d)
+                assert False
+            except tarfile.TarError:
+                pass
+            os.symlink('/etc', os.path.join(d, 'app'))  # writing through a link
+            try:
+                _check_tar_member(tarfile.TarInfo('app/passwd'), d)
+                assert False
+            except tarfile.TarError:
+                pass
+
+    check_metrics_parser()
+    check_metrics_series()
+    check_compress_decision()
+    check_tar_member()
     test_logcat()